@@ -1,9 +1,13 @@
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
-import re
+from google import genai
+from google.genai import types
 import json
 import os
+import hashlib
+import uuid
+import threading
+import shutil
 
 # --- ページ設定 ---
 st.set_page_config(page_title="視聴管理アプリ with Gemini", page_icon="📺")
@@ -12,166 +16,604 @@ st.markdown("視聴した作品の内容と感想を登録しましょう!")
 
 # --- 定数定義 ---
 # 保存するデータファイルの名前
-DATA_FILE = "works_data.json"
+DATA_FILE = "works_data.jsonl"
+# 以前の形式（JSON配列）のデータファイルの名前
+LEGACY_DATA_FILE = "works_data.json"
+# 削除記録がこの件数を超えたら読み込み時にファイルを詰め直す
+COMPACT_THRESHOLD = 50
+# Geminiの応答をキャッシュするファイルの名前
+CACHE_FILE = "gemini_cache.json"
+# 使用するGeminiモデルの名前
+MODEL_NAME = "gemini-1.5-flash"
+# 作品情報の応答として受け取るJSONの形式
+WORK_INFO_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "viewing_time": {"type": "STRING"},
+        "total_minutes": {"type": "INTEGER"},
+        "reputation": {"type": "STRING"}
+    },
+    "required": ["viewing_time", "total_minutes", "reputation"]
+}
+# 作品情報1件あたりの出力トークン数の上限
+WORK_INFO_MAX_TOKENS = 300
+# 使用するGeminiモデルが1回の応答で出力できるトークン数の上限
+MODEL_MAX_OUTPUT_TOKENS = 8192
+# まとめて登録で1回のリクエストに含める作品数
+BULK_BATCH_SIZE = MODEL_MAX_OUTPUT_TOKENS // WORK_INFO_MAX_TOKENS
+# 作品の分類の選択肢
+CATEGORIES = ["アニメ", "映画", "ドラマ", "特撮", "その他"]
 
 # --- APIキー設定 ---
 try:
     # Streamlitのシークレット管理からAPIキーを取得
     api_key = st.secrets["GEMINI_API_KEY"]
-    genai.configure(api_key=api_key)
 except (KeyError, AttributeError):
     st.error("⚠️ Gemini APIキーが設定されていません。st.secretsに 'GEMINI_API_KEY' を設定してください。")
     st.stop()
 
+# --- Geminiクライアントの取得関数 ---
+@st.cache_resource
+def get_client():
+    """
+    Geminiクライアントを生成する関数（プロセス内で1度だけ生成し、HTTP接続を使い回す）
+    """
+    return genai.Client(api_key=api_key)
+
 # --- データ保存・読み込み関数 ---
+@st.cache_resource
+def get_data_lock():
+    """
+    視聴履歴ファイルへの書き込みと読み込みを直列化するロックを返す関数（全セッションで共有）
+    コンパクション中にsave_dataを呼ぶため、同じスレッドから再取得できるRLockを使います。
+    """
+    return threading.RLock()
+
+def write_file_atomically(path, text):
+    """
+    同じディレクトリの一時ファイルに書き込んでから置き換える関数
+    一時ファイル名は書き込みごとに異なるため、複数のセッションが同時に保存しても混ざりません。
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        # 通常のopenで作成するため、新規ファイルのパーミッションはumaskに従う
+        with open(tmp_path, 'x', encoding='utf-8') as f:
+            f.write(text)
+        if os.path.exists(path):
+            # 既存ファイルのパーミッションを引き継ぐ
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # 書き込みに失敗した一時ファイルは残さない
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def save_data(data):
     """
-    視聴履歴データをJSONファイルに保存する関数
+    視聴履歴データをJSONLファイルに書き直す関数（全削除・コンパクション用）
+    """
+    with get_data_lock():
+        write_file_atomically(DATA_FILE, "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in data))
+    # 新しいセッションが最新の内容を読み込むよう、共有キャッシュを破棄する
+    _load_cached.clear()
+
+def append_record(record):
+    """
+    JSONLファイルの末尾に1行追記する関数
+    """
+    with get_data_lock():
+        with open(DATA_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    _load_cached.clear()
+
+def delete_record(data, index):
+    """
+    視聴履歴から記録を削除し、削除記録（トゥームストーン）を追記する関数
     """
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    record = data.pop(index)
+    append_record({"_tombstone": record["id"]})
+
+def migrate_legacy_data():
+    """
+    以前の形式のJSONファイルを読み込み、IDを付けてJSONLファイルに書き出す関数
+    """
+    try:
+        with open(LEGACY_DATA_FILE, 'r', encoding='utf-8') as f:
+            works = json.load(f)
+    except json.JSONDecodeError:
+        # ファイルが空または破損している場合は空のリストとして扱う
+        works = []
+    for record in works:
+        record.setdefault("id", uuid.uuid4().hex)
+    save_data(works)
+    return works
 
 def load_data():
     """
-    JSONファイルから視聴履歴データを読み込む関数
+    JSONLファイルから視聴履歴データを読み込む関数
+    追記と削除記録を先頭から順に再生し、削除記録が多ければファイルを詰め直します。
+    """
+    # 読み込みとコンパクションの間に他のセッションの追記が割り込まないようにする
+    with get_data_lock():
+        if not os.path.exists(DATA_FILE):
+            if os.path.exists(LEGACY_DATA_FILE):
+                return migrate_legacy_data()
+            return []
+        # 記録はIDをキーにして保持し、削除記録のIDと一致するものを取り除く
+        works = {}
+        tombstones = 0
+        with open(DATA_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で壊れた行は読み飛ばす
+                    continue
+                if "_tombstone" in record:
+                    works.pop(record["_tombstone"], None)
+                    tombstones += 1
+                else:
+                    works[record["id"]] = record
+        works = list(works.values())
+        if tombstones > COMPACT_THRESHOLD:
+            save_data(works)
+        return works
+
+@st.cache_resource
+def _load_cached():
+    """
+    読み込んだ視聴履歴をプロセス内の全セッションで共有する関数（書き込みのたびに破棄される）
+    """
+    return load_data()
+
+# --- Gemini応答キャッシュ関数 ---
+@st.cache_resource
+def load_gemini_cache():
     """
-    if os.path.exists(DATA_FILE):
+    キャッシュファイルからGeminiの応答を読み込む関数（全セッションで共有）
+    """
+    if os.path.exists(CACHE_FILE):
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
                 return json.load(f)
         except json.JSONDecodeError:
-            # ファイルが空または破損している場合は空のリストを返す
-            return []
-    return []
+            # ファイルが破損している場合は空のキャッシュから始める
+            return {}
+    return {}
+
+def save_gemini_cache(cache):
+    """
+    Geminiの応答キャッシュをファイルに保存する関数
+    """
+    write_file_atomically(CACHE_FILE, json.dumps(cache, ensure_ascii=False))
+
+@st.cache_resource
+def get_cache_lock():
+    """
+    応答キャッシュの更新と保存を直列化するロックを返す関数（全セッションで共有）
+    スクリプトは再実行のたびに評価し直されるため、ロックもcache_resourceで共有します。
+    """
+    return threading.Lock()
+
+def store_work_info(entries):
+    """
+    取得に成功した作品情報を応答キャッシュに追加し、ファイルに保存する関数
+    """
+    with get_cache_lock():
+        cache = load_gemini_cache()
+        cache.update(entries)
+        # 他のセッションの更新と衝突しないよう、ロック中に取ったコピーを保存する
+        save_gemini_cache(dict(cache))
+
+def make_cache_key(title: str) -> str:
+    """
+    作品タイトルを正規化してキャッシュのキーを作る関数
+    """
+    return hashlib.sha1(title.strip().lower().encode('utf-8')).hexdigest()
+
+def lookup_cached_work_info(title: str):
+    """
+    キャッシュ済みの作品情報を返す関数（未取得の場合はNoneを返す）
+    """
+    cached = load_gemini_cache().get(make_cache_key(title))
+    return tuple(cached) if cached else None
 
 # --- Gemini AIによる作品情報取得関数 ---
+def parse_work_info(data) -> tuple[str, int, str]:
+    """
+    JSONで受け取った作品情報を(視聴時間の概要, 総視聴時間, 一般的な評価)に変換する関数
+    """
+    try:
+        return data["viewing_time"], int(data["total_minutes"]), data["reputation"]
+    except (KeyError, TypeError, ValueError):
+        return "情報取得失敗", 0, "AIからの応答形式が正しくありませんでした。"
+
+def is_truncated(response) -> bool:
+    """
+    AIの応答が出力トークン数の上限で途中で切れたかどうかを判定する関数
+    """
+    return bool(response.candidates) and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+
+def make_work_info_config(response_schema, count: int = 1) -> types.GenerateContentConfig:
+    """
+    作品情報の取得用に、JSON形式・出力トークン数の上限・低めのtemperatureを指定した設定を作る関数
+    """
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=response_schema,
+        max_output_tokens=min(WORK_INFO_MAX_TOKENS * count, MODEL_MAX_OUTPUT_TOKENS),
+        temperature=0.2
+    )
+
 def get_work_info_with_gemini(title: str) -> tuple[str, int, str]:
     """
     Gemini AIを使用して、与えられた映像作品の基本情報を取得します。
+    一度取得した作品はキャッシュファイルから返し、Geminiへの問い合わせを省略します。
     """
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    cached = lookup_cached_work_info(title)
+    if cached:
+        return cached
+
+    client = get_client()
     
     prompt = f"""あなたは映像作品情報のエキスパートです。以下の映像作品のタイトルについて、指定された形式で情報を教えてください。
     
     作品タイトル: {title}
 
-    以下の3つの情報を、必ず区切り文字「|||」で区切って出力してください。
-    1. 視聴時間の概要（例: 全12話、各話約24分 / 映画 124分）
-    2. シリーズ全体の総視聴時間（分単位の整数のみ。例: 288）
-    3. 一般的な評価や評判の概要（200文字程度）
+    以下の3つの情報をJSONで出力してください。
+    - viewing_time: 視聴時間の概要（例: 全12話、各話約24分 / 映画 124分）
+    - total_minutes: シリーズ全体の総視聴時間（分単位の整数。例: 288）
+    - reputation: 一般的な評価や評判の概要（100文字程度）
 
     出力形式の例:
-    全28話、1話約24分|||672|||非常に高い評価を受けており、多くのレビューサイトで満点に近いスコアを記録しています。特に、感動的なストーリーとキャラクターの深い心理描写が称賛されています。
+    {{"viewing_time": "全28話、1話約24分", "total_minutes": 672, "reputation": "非常に高い評価を受けており、感動的なストーリーとキャラクターの深い心理描写が称賛されています。"}}
     """
 
     try:
-        response = model.generate_content(prompt)
-        parts = response.text.split('|||')
-        if len(parts) == 3:
-            viewing_time_summary = parts[0].strip()
-            total_minutes_str = re.search(r'\d+', parts[1])
-            total_minutes = int(total_minutes_str.group()) if total_minutes_str else 0
-            reputation = parts[2].strip()
-            return viewing_time_summary, total_minutes, reputation
-        else:
-            return "情報取得失敗", 0, "AIからの応答形式が正しくありませんでした。"
+        response = client.models.generate_content(
+            model=MODEL_NAME, contents=prompt, config=make_work_info_config(WORK_INFO_SCHEMA)
+        )
+        if is_truncated(response):
+            return "情報取得失敗", 0, "AIの応答が長すぎて途中で切れました。時間をおいてもう一度お試しください。"
+        viewing_time_summary, total_minutes, reputation = parse_work_info(json.loads(response.text))
+        if total_minutes > 0:
+            # 取得に成功した結果のみキャッシュに保存する
+            store_work_info({make_cache_key(title): [viewing_time_summary, total_minutes, reputation]})
+        return viewing_time_summary, total_minutes, reputation
+    except json.JSONDecodeError:
+        return "情報取得失敗", 0, "AIからの応答形式が正しくありませんでした。"
     except Exception as e:
         st.error(f"AIによる情報取得中にエラーが発生しました: {e}")
         return "情報取得失敗", 0, "APIエラーが発生しました。"
 
-# --- Gemini AIによる分析・提案関数 ---
-def analyze_with_gemini(prompt: str) -> str:
+def get_works_info_with_gemini(titles: list[str]) -> list[tuple[str, int, str]]:
     """
-    与えられたプロンプトに基づいてGemini AIで分析や提案を生成します。
+    Gemini AIを使用して、複数の映像作品の基本情報をBULK_BATCH_SIZE件ずつまとめて取得します。
+    キャッシュ済みの作品は問い合わせ対象から除き、結果はtitlesと同じ順で返します。
     """
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    results = {title: lookup_cached_work_info(title) for title in titles}
+    pending = [title for title, info in results.items() if info is None]
+
+    # 出力トークン数の上限に収まるよう、一定件数ずつに分けて問い合わせる
+    for start in range(0, len(pending), BULK_BATCH_SIZE):
+        results.update(request_works_info(pending[start:start + BULK_BATCH_SIZE]))
+
+    return [results[title] or ("情報取得失敗", 0, "情報を取得できませんでした。") for title in titles]
+
+def request_works_info(batch: list[str]) -> dict:
+    """
+    Gemini AIに1回のリクエストで複数作品の情報を問い合わせ、{タイトル: 作品情報}を返す関数
+    取得に失敗した場合は空の辞書を返します。
+    """
+    results = {}
+    client = get_client()
+    title_list_str = "\n".join(f"- {title}" for title in batch)
+
+    prompt = f"""あなたは映像作品情報のエキスパートです。以下の{len(batch)}件の映像作品のタイトルについて、指定された形式で情報を教えてください。
+
+    作品タイトル一覧:
+    {title_list_str}
+
+    作品ごとに以下の3つの情報を持つオブジェクトを、一覧と同じ順番でJSONの配列にして出力してください。
+    - viewing_time: 視聴時間の概要（例: 全12話、各話約24分 / 映画 124分）
+    - total_minutes: シリーズ全体の総視聴時間（分単位の整数。例: 288）
+    - reputation: 一般的な評価や評判の概要（100文字程度）
+
+    出力形式の例:
+    [{{"viewing_time": "全28話、1話約24分", "total_minutes": 672, "reputation": "非常に高い評価を受けており、感動的なストーリーとキャラクターの深い心理描写が称賛されています。"}},
+     {{"viewing_time": "映画 106分", "total_minutes": 106, "reputation": "美しい映像と音楽が高く評価され、国内外で大ヒットを記録しました。"}}]
+    """
+
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        response = client.models.generate_content(
+            model=MODEL_NAME,
+            contents=prompt,
+            config=make_work_info_config({"type": "ARRAY", "items": WORK_INFO_SCHEMA}, len(batch))
+        )
+        if is_truncated(response):
+            st.error("AIの応答が長すぎて途中で切れました。時間をおいてもう一度お試しください。")
+            return results
+        items = json.loads(response.text)
+        if isinstance(items, list) and len(items) == len(batch):
+            entries = {}
+            for title, item in zip(batch, items):
+                info = parse_work_info(item)
+                results[title] = info
+                if info[1] > 0:
+                    entries[make_cache_key(title)] = list(info)
+            if entries:
+                store_work_info(entries)
+        else:
+            st.error("AIからの応答形式が正しくありませんでした。")
+    except json.JSONDecodeError:
+        st.error("AIからの応答形式が正しくありませんでした。")
     except Exception as e:
-        st.error(f"AIとの通信中にエラーが発生しました: {e}")
-        return "分析・提案の生成に失敗しました。"
+        st.error(f"AIによる情報取得中にエラーが発生しました: {e}")
+
+    return results
+
+# --- プロンプト用の作品リスト作成関数 ---
+@st.cache_data(show_spinner=False)
+def build_work_list_str(works_tuple: tuple) -> str:
+    """
+    (タイトル, 分類, 評価, 感想)のタプルの並びから、プロンプト用の作品リスト文字列を作成する関数
+    """
+    return "\n".join(
+        f"- 作品名: {title}, 分類: {category}, あなたの評価: {rating}/5, 感想: {impression}"
+        for title, category, rating, impression in works_tuple
+    )
+
+# --- グラフ用データ作成関数 ---
+@st.cache_data(show_spinner=False)
+def chart_and_total(works_tuple: tuple) -> tuple[pd.Series, float]:
+    """
+    (タイトル, 総視聴時間)のタプルの並びから、グラフ用のデータと合計視聴時間（時間）を作成する関数
+    """
+    titles = [title for title, _ in works_tuple]
+    minutes = [total_minutes for _, total_minutes in works_tuple]
+    return pd.Series(minutes, index=titles, name="総視聴時間(分)"), sum(minutes) / 60
+
+# --- ストリーム分割関数 ---
+def split_stream(chunks, delimiter: str):
+    """
+    文字列のストリームを区切り文字の前後で2つのジェネレータに分ける関数
+    前半のジェネレータを最後まで読んでから後半を読んでください。
+    """
+    chunks = iter(chunks)
+    rest = []
+
+    def head():
+        buffer = ""
+        for text in chunks:
+            buffer += text
+            if delimiter in buffer:
+                before, after = buffer.split(delimiter, 1)
+                rest.append(after)
+                yield before
+                return
+            # 区切り文字の途中かもしれない末尾は次のチャンクまで保留する
+            cut = len(buffer) - len(delimiter) + 1
+            if cut > 0:
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+        yield buffer
+
+    def tail():
+        yield from rest
+        yield from chunks
+
+    return head(), tail()
+
+# --- Gemini AIによる好み分析＆おすすめ提案関数 ---
+def stream_analysis_and_recs(work_list_str: str, watched_titles: str):
+    """
+    Gemini AIで好みの分析とおすすめ作品の提案を1回のリクエストでまとめて生成します。
+    応答は受信した順に、分析結果とおすすめ作品の2つのジェネレータに分けて返します。
+    """
+    client = get_client()
+
+    prompt = f"""あなたはプロの映像作品アナリストであり、優れた映像作品コンシェルジュです。
+    以下の視聴履歴を持つユーザーについて、AとBの2つの作業を行ってください。
+
+    A. ユーザーの好みの傾向を分析し、簡潔にまとめてください。
+       特に、評価が高い作品（評価4以上）に注目してください。
+       どのようなジャンル、テーマ、作風、キャラクター像を好むかを具体的に分析してください。
+    B. ユーザーの好みを踏まえて、次に見るべきおすすめの映像作品を3つ厳選して提案してください。
+       提案する作品は、ユーザーがまだ見ていないものにしてください。
+       それぞれの作品について、なぜおすすめなのか理由も50字程度で簡潔に付け加えてください。
+
+    【ユーザーの視聴履歴】
+    {work_list_str}
+
+    【ユーザーが視聴済みの作品リスト（これらは提案しないでください）】
+    {watched_titles}
+
+    【出力形式】
+    まずAの分析結果を出力し、続けて区切り文字「|||」を1度だけ出力し、その後にBのおすすめ作品を出力してください。
+    Bは以下の形式で出力してください。
+    - **【作品名1】**: ユーザーの「〇〇」という好みに合っており、特に△△な点が楽しめるはずです。
+    - **【作品名2】**: □□と似た雰囲気で、より深く××というテーマを掘り下げています。
+    - **【作品名3】**: 高評価をつけた△△の監督の別作品で、きっと気に入ると思います。
+    """
+
+    stream = client.models.generate_content_stream(model=MODEL_NAME, contents=prompt)
+    return split_stream((chunk.text or "" for chunk in stream), '|||')
+
+# --- 視聴記録作成関数 ---
+def make_work_record(title, category, impression, user_rating, viewing_time_summary, total_minutes, reputation):
+    """
+    入力内容とAIが取得した作品情報から、1件分の視聴記録を作成する関数
+    """
+    return {
+        "id": uuid.uuid4().hex,
+        "タイトル": title,
+        "分類": category,
+        "感想": impression,
+        "あなたの評価": "★" * user_rating,
+        "評価(数値)": user_rating,
+        "視聴時間(概要)": viewing_time_summary,
+        "総視聴時間(分)": total_minutes,
+        "一般的な評価": reputation
+    }
+
+def is_valid_title(title: str) -> bool:
+    """
+    Geminiに問い合わせる価値のあるタイトルかどうかを判定する関数
+    """
+    return len(title) >= 2 and not title.isnumeric()
+
+# --- 作品詳細表示関数 ---
+@st.fragment
+def render_detail(index, row):
+    """
+    選択された1件の視聴記録の詳細と削除ボタンを表示する関数
+    フラグメントとして描画し、アプリ全体の再実行は記録を削除したときだけ行います。
+    """
+    with st.container(border=True):
+        st.markdown(f"#### **{row['タイトル']}** ({row['分類']} - {row['あなたの評価']})")
+        st.markdown("##### 🤖 AIによる作品情報")
+        st.info(f"**一般的な評価:** {row['一般的な評価']}")
+        st.markdown(f"**視聴時間の目安:** {row['視聴時間(概要)']} (合計 約{row['総視聴時間(分)']}分)")
+        st.markdown("---")
+        st.markdown("##### 💬 あなたの感想")
+        if row['感想']:
+            st.write(row['感想'])
+        else:
+            st.caption("感想は登録されていません。")
+
+        # --- ここから削除機能 ---
+        st.markdown("---")
+        if st.button("この記録を削除する", key=f"delete_{index}", help="この視聴記録を削除します。"):
+            # st.session_state.worksから該当の記録を削除し、削除記録をファイルに追記
+            delete_record(st.session_state.works, index)
+            st.success(f"「{row['タイトル']}」の記録を削除しました。")
+            # 画面を再読み込みして表示を更新
+            st.rerun()
 
 # --- セッションステートの初期化 ---
-# アプリの初回起動時のみファイルからデータを読み込む
+# アプリの初回起動時のみ、全セッションで共有している視聴履歴をコピーして使う
 if "works" not in st.session_state:
-    st.session_state.works = load_data()
+    st.session_state.works = list(_load_cached())
 
 
 # --- 入力フォーム ---
 st.subheader("✍️ 新しい視聴記録を登録")
 with st.form("work_form", clear_on_submit=True):
     title = st.text_input("作品タイトル", placeholder="例：葬送のフリーレン")
-    category = st.selectbox("分類", ["アニメ", "映画", "ドラマ", "特撮", "その他"], help="作品の分類を選択してください")
+    category = st.selectbox("分類", CATEGORIES, help="作品の分類を選択してください")
     impression = st.text_area("感想", height=100, placeholder="例：映像が綺麗で、キャラクターの感情が丁寧に描かれていて感動した。")
     user_rating = st.slider("あなたの評価", 1, 5, 3, help="5段階で評価してください（1:悪い - 5:最高）")
     submit_button = st.form_submit_button("登録する", help="視聴記録を登録します。Gemini AIが情報を取得します。")
 
+with st.expander("📚 複数の作品をまとめて登録"):
+    with st.form("bulk_work_form", clear_on_submit=True):
+        bulk_titles = st.text_area("複数タイトル（1行1作品）", height=120, placeholder="例：\n葬送のフリーレン\n君の名は。", key="bulk_titles")
+        bulk_category = st.selectbox("分類", CATEGORIES, help="まとめて登録する作品の分類を選択してください", key="bulk_category")
+        bulk_rating = st.slider("あなたの評価", 1, 5, 3, help="まとめて登録する作品の評価です（1:悪い - 5:最高）", key="bulk_rating")
+        bulk_submit_button = st.form_submit_button("まとめて登録する", help="Gemini AIが全ての作品の情報を1回でまとめて取得します。")
+
 
 # --- 登録処理 ---
-if submit_button and title:
-    with st.spinner(f"Gemini AIが「{title}」の情報を調べています..."):
-        viewing_time_summary, total_minutes, reputation = get_work_info_with_gemini(title)
-    
+title = title.strip()
+if submit_button and title and not is_valid_title(title):
+    # 明らかに作品名ではない入力はGeminiに問い合わせずに弾く
+    st.warning("作品タイトルは2文字以上で、数字だけにならないように入力してください。")
+elif submit_button and title:
+    cached = lookup_cached_work_info(title)
+    if cached:
+        # 取得済みの作品はスピナーを出さずにキャッシュから登録する
+        viewing_time_summary, total_minutes, reputation = cached
+    else:
+        with st.spinner(f"Gemini AIが「{title}」の情報を調べています..."):
+            viewing_time_summary, total_minutes, reputation = get_work_info_with_gemini(title)
+
     if total_minutes > 0:
-        st.session_state.works.append({
-            "タイトル": title,
-            "分類": category,
-            "感想": impression,
-            "あなたの評価": "★" * user_rating,
-            "評価(数値)": user_rating,
-            "視聴時間(概要)": viewing_time_summary,
-            "総視聴時間(分)": total_minutes,
-            "一般的な評価": reputation
-        })
-        # データを追加した直後にファイルに保存
-        save_data(st.session_state.works)
+        record = make_work_record(title, category, impression, user_rating, viewing_time_summary, total_minutes, reputation)
+        st.session_state.works.append(record)
+        # データを追加した直後にファイルへ1行追記
+        append_record(record)
         st.success(f"「{title}」の記録を登録しました！")
         st.balloons()
     else:
-        st.error(f"「{title}」の情報を取得できませんでした。作品名が正しいか確認してください。")
+        if viewing_time_summary == "情報取得失敗":
+            # 応答の途中切れや通信エラーなど、取得に失敗した理由は一般的な評価の欄に入っている
+            st.error(f"「{title}」の情報を取得できませんでした。{reputation}")
+        else:
+            st.error(f"「{title}」の情報を取得できませんでした。作品名が正しいか確認してください。")
+
+# --- まとめて登録処理 ---
+if bulk_submit_button:
+    # 空行を除き、重複したタイトルは最初の1件だけを残す
+    bulk_lines = list(dict.fromkeys(t.strip() for t in bulk_titles.splitlines() if t.strip()))
+    bulk_title_list = [t for t in bulk_lines if is_valid_title(t)]
+    rejected = [t for t in bulk_lines if not is_valid_title(t)]
+
+    registered, failed = [], []
+    if bulk_title_list:
+        with st.spinner(f"Gemini AIが{len(bulk_title_list)}件の作品情報をまとめて調べています..."):
+            infos = get_works_info_with_gemini(bulk_title_list)
+
+        for bulk_title, (viewing_time_summary, total_minutes, reputation) in zip(bulk_title_list, infos):
+            if total_minutes > 0:
+                record = make_work_record(bulk_title, bulk_category, "", bulk_rating, viewing_time_summary, total_minutes, reputation)
+                st.session_state.works.append(record)
+                append_record(record)
+                registered.append(bulk_title)
+            else:
+                failed.append(bulk_title)
+
+    if registered:
+        st.success(f"{len(registered)}件の記録を登録しました！（{'、'.join(registered)}）")
+    if failed or rejected:
+        messages = []
+        if failed:
+            messages.append(f"情報を取得できなかった作品: {'、'.join(failed)}")
+        if rejected:
+            messages.append(f"作品タイトルとして扱えない行（2文字以上で、数字だけにならないように入力してください）: {'、'.join(rejected)}")
+        st.error("次の作品は登録できませんでした。\n\n" + "\n\n".join(messages))
+    if not bulk_lines:
+        st.warning("登録できる作品タイトルがありません。1行に1作品ずつ入力してください。")
 
 # --- 登録済み一覧表示 ---
 if st.session_state.works:
     st.subheader("🎞️ 視聴履歴")
     
-    df = pd.DataFrame(st.session_state.works)
-    
-    # 各作品の詳細をエキスパンダーで表示
-    # インデックスを逆順にして新しいものが上にくるようにする
-    for index in reversed(df.index):
-        row = df.loc[index]
-        with st.expander(f"**{row['タイトル']}** ({row['分類']} - {row['あなたの評価']})"):
-            st.markdown("##### 🤖 AIによる作品情報")
-            st.info(f"**一般的な評価:** {row['一般的な評価']}")
-            st.markdown(f"**視聴時間の目安:** {row['視聴時間(概要)']} (合計 約{row['総視聴時間(分)']}分)")
-            st.markdown("---")
-            st.markdown("##### 💬 あなたの感想")
-            if row['感想']:
-                st.write(row['感想'])
-            else:
-                st.caption("感想は登録されていません。")
-            
-            # --- ここから削除機能 ---
-            st.markdown("---")
-            if st.button("この記録を削除する", key=f"delete_{index}", help="この視聴記録を削除します。"):
-                # st.session_state.worksから該当の記録を削除
-                st.session_state.works.pop(index)
-                # 変更をファイルに保存
-                save_data(st.session_state.works)
-                st.success(f"「{row['タイトル']}」の記録を削除しました。")
-                # 画面を再読み込みして表示を更新
-                st.rerun()
+    st.caption("行を選択すると、その作品の詳細が表示されます。")
+
+    # 一覧は1つの表で表示し、新しいものが上にくるよう逆順に並べる
+    history_df = pd.DataFrame(
+        list(reversed(st.session_state.works)),
+        columns=["タイトル", "分類", "あなたの評価", "視聴時間(概要)", "総視聴時間(分)"]
+    )
+    # 件数が変わったら選択状態をリセットするため、件数をキーに含める
+    event = st.dataframe(
+        history_df,
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"history_{len(st.session_state.works)}"
+    )
+
+    # 選択された作品の詳細だけを表示する
+    if event.selection.rows:
+        index = len(st.session_state.works) - 1 - event.selection.rows[0]
+        row = st.session_state.works[index]
+        render_detail(index, row)
 
     st.markdown("---")
 
     # --- 視聴時間の可視化 ---
     st.subheader("📊 視聴時間のグラフ")
     
-    if not df.empty and "総視聴時間(分)" in df.columns:
-        chart_df = df[["タイトル", "総視聴時間(分)"]].set_index("タイトル")
-        st.bar_chart(chart_df)
-        total_hours = df["総視聴時間(分)"].sum() / 60
+    # グラフと合計に必要な列だけをキーにして、履歴が変わらない限り計算を使い回す
+    chart_series, total_hours = chart_and_total(tuple(
+        (w["タイトル"], w["総視聴時間(分)"]) for w in st.session_state.works
+    ))
+
+    if not chart_series.empty:
+        st.bar_chart(chart_series)
         st.markdown(f"**合計視聴時間:** 約 **{total_hours:.1f}** 時間")
     else:
         st.warning("グラフを表示するためのデータがありません。")
@@ -185,57 +627,49 @@ if st.session_state.works:
     col1, col2 = st.columns(2)
 
     with col1:
-        if st.button("📈 あなたの好みを分析する"):
-            with st.spinner("AIがあなたの好みを分析中です..."):
-                work_list_str = ""
-                for index, row in df.iterrows():
-                    work_list_str += f"- 作品名: {row['タイトル']}, 分類: {row['分類']}, あなたの評価: {row['評価(数値)']}/5, 感想: {row['感想']}\n"
-
-                prompt = f"""あなたはプロの映像作品アナリストです。
-                以下の視聴履歴を持つユーザーの好みの傾向を分析し、簡潔にまとめてください。
-                特に、評価が高い作品（評価4以上）に注目してください。
-                どのようなジャンル、テーマ、作風、キャラクター像を好むかを具体的に分析してください。
-
-                【ユーザーの視聴履歴】
-                {work_list_str}
-
-                【分析結果】
-                """
-                
-                analysis_result = analyze_with_gemini(prompt)
-                st.subheader("🔍 あなたの好み分析結果")
-                st.success(analysis_result)
-
+        analyze_clicked = st.button("📈 あなたの好みを分析する")
     with col2:
-        if st.button("🎯 おすすめ作品を提案してもらう"):
-            with st.spinner("AIがあなたにぴったりの作品を選んでいます..."):
-                sorted_df = df.sort_values("評価(数値)", ascending=False)
-                work_list_str = ""
-                for index, row in sorted_df.iterrows():
-                        work_list_str += f"- 作品名: {row['タイトル']}, 分類: {row['分類']}, あなたの評価: {row['評価(数値)']}/5\n"
-                
-                watched_titles = ", ".join(df['タイトル'].tolist())
-
-                prompt = f"""あなたは優れた映像作品コンシェルジュです。
-                以下の視聴履歴を持つユーザーの好みを踏まえて、次に見るべきおすすめの映像作品を3つ厳選して提案してください。
-                提案する作品は、ユーザーがまだ見ていないものにしてください。
-                それぞれの作品について、なぜおすすめなのか理由も50字程度で簡潔に付け加えてください。
-
-                【ユーザーの視聴履歴】
-                {work_list_str}
-
-                【ユーザーが視聴済みの作品リスト（これらは提案しないでください）】
-                {watched_titles}
-
-                【出力形式の例】
-                - **【作品名1】**: ユーザーの「〇〇」という好みに合っており、特に△△な点が楽しめるはずです。
-                - **【作品名2】**: □□と似た雰囲気で、より深く××というテーマを掘り下げています。
-                - **【作品名3】**: 高評価をつけた△△の監督の別作品で、きっと気に入ると思います。
-                """
-                
-                recommendations = analyze_with_gemini(prompt)
+        recommend_clicked = st.button("🎯 おすすめ作品を提案してもらう")
+
+    # プロンプトに渡す内容（評価の高い順に並べた作品リスト）を、そのまま分析結果のキーにも使う
+    sorted_works = sorted(st.session_state.works, key=lambda w: -w["評価(数値)"])
+    works_tuple = tuple((w["タイトル"], w["分類"], w["評価(数値)"], w["感想"]) for w in sorted_works)
+
+    # 履歴が変わっていなければ、前回の分析結果をセッションステートから描画する
+    history_hash = hash(works_tuple)
+    has_saved_result = st.session_state.get("analysis_hash") == history_hash
+
+    if has_saved_result:
+        with col1:
+            st.subheader("🔍 あなたの好み分析結果")
+            st.markdown(st.session_state.analysis_result)
+        with col2:
+            st.subheader("✨ あなたへのおすすめ作品")
+            st.markdown(st.session_state.recommendations_result)
+
+    # 分析とおすすめは1回のリクエストでまとめて取得し、届いた順に表示する
+    elif analyze_clicked or recommend_clicked:
+        work_list_str = build_work_list_str(works_tuple)
+
+        watched_titles = ", ".join(w["タイトル"] for w in st.session_state.works)
+
+        analysis_stream, recommendation_stream = stream_analysis_and_recs(work_list_str, watched_titles)
+        try:
+            with col1:
+                st.subheader("🔍 あなたの好み分析結果")
+                analysis_result = st.write_stream(analysis_stream)
+            with col2:
                 st.subheader("✨ あなたへのおすすめ作品")
-                st.markdown(recommendations)
+                recommendations = st.write_stream(recommendation_stream)
+                if not recommendations:
+                    st.error("AIからの応答形式が正しくありませんでした。")
+                else:
+                    # 成功した結果だけを履歴のハッシュと一緒に保存する
+                    st.session_state.analysis_hash = history_hash
+                    st.session_state.analysis_result = analysis_result
+                    st.session_state.recommendations_result = recommendations
+        except Exception as e:
+            st.error(f"AIとの通信中にエラーが発生しました: {e}")
     
     st.markdown("---")
     